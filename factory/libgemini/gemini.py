@@ -40,6 +40,7 @@ class SysExCommands(enum.IntEnum):
     SOFT_RESET = 0x11
     ENTER_CALIBRATION = 0x12
     RESET_INTO_BOOTLOADER = 0x13
+    SET_PERIOD_AND_DAC = 0x14
 
 
 class Gemini(midi.MIDIDevice):
@@ -68,6 +69,11 @@ class Gemini(midi.MIDIDevice):
 
         self.sysex(SysExCommands.ENTER_CALIBRATION)
 
+    def wait_until_ready(self):
+        # SysEx commands are handled in order, so once the device answers HELLO
+        # it's finished processing everything sent before it.
+        self.sysex(SysExCommands.HELLO, response=True)
+
     def read_adc(self, ch):
         resp = self.sysex(SysExCommands.READ_ADC, data=[ch], response=True, decode=True)
         (val,) = struct.unpack(">H", resp)
@@ -81,6 +87,10 @@ class Gemini(midi.MIDIDevice):
         data = struct.pack(">BI", ch, val)
         self.sysex(SysExCommands.SET_FREQ, data=data, encode=True)
 
+    def set_period_and_dac(self, ch, period, dac_ch, val, vref):
+        data = struct.pack(">BIBHB", ch, period, dac_ch, val, vref)
+        self.sysex(SysExCommands.SET_PERIOD_AND_DAC, data=data, encode=True)
+
     def set_adc_gain_error_int(self, val):
         data = struct.pack(">H", val)
         self.sysex(SysExCommands.WRITE_ADC_GAIN, data=data, encode=True)
@@ -135,9 +145,25 @@ class Gemini(midi.MIDIDevice):
             )
             self.sysex(SysExCommands.WRITE_SETTINGS, data=[n] + chunk, response=True)
 
-    def write_lut_entry(self, entry, period, castor, pollux):
+    def write_lut_entry(self, entry, period, castor, pollux, wait_for_ack=True):
         data = struct.pack(">BIHH", entry, period, castor, pollux)
-        self.sysex(SysExCommands.WRITE_LUT_ENTRY, data=data, encode=True, response=True)
+        self.sysex(
+            SysExCommands.WRITE_LUT_ENTRY,
+            data=data,
+            encode=True,
+            response=wait_for_ack,
+        )
+
+    def wait_for_lut_entry_acks(self, count):
+        # Collects the acknowledgements for entries written with
+        # wait_for_ack=False, so that a whole table can be sent without a
+        # round-trip per entry.
+        for _ in range(count):
+            resp = self.wait_for_message()
+            if resp[2] != SysExCommands.WRITE_LUT_ENTRY:
+                raise RuntimeError(
+                    f"Expected a LUT entry acknowledgement, got command {resp[2]:02x}"
+                )
 
     def write_lut(self):
         self.sysex(SysExCommands.WRITE_LUT)
@@ -3,7 +3,10 @@
 # Full text available at: https://opensource.org/licenses/MIT
 
 import argparse
+import bisect
+import functools
 import json
+import operator
 import os.path
 import pathlib
 import statistics
@@ -15,22 +18,25 @@ from wintertools import interactive, log, oscilloscope, tui
 from libgemini import gemini, oscillators, reference_calibration
 
 here = os.path.abspath(os.path.dirname(__file__))
-period_to_dac_code = reference_calibration.castor.copy()
 start_color = (1.0, 1.0, 0.0)
 end_color = (0.5, 0.6, 1.0)
 
 AVERAGE_COUNT = 2
 
+# Scope time divisions for ramps above each frequency (in Hz), lowest first.
+TIME_DIVISION_FREQUENCIES = (46, 90, 180, 700, 1200)
+TIME_DIVISIONS = ("5ms", "2ms", "1ms", "500us", "200us", "100us")
+
 
 # Use max because PK-PK has poor resolution and also includes negative transients.
 def _measure_max(scope, scope_channel):
-    return statistics.mean(
+    return statistics.fmean(
         scope.get_max(scope_channel) for _ in range(0, AVERAGE_COUNT)
     )
 
 
-def _manual_seek(gem, dac_channel, charge_code):
-    gem.set_dac(dac_channel, charge_code, 0)
+def _manual_seek(gem, oscillator, period, dac_channel, charge_code):
+    gem.set_period_and_dac(oscillator, period, dac_channel, charge_code, 0)
     adjuster = interactive.adjust_value(charge_code, min=0, max=4095)
     output = tui.Updateable()
 
@@ -46,94 +52,119 @@ def _manual_seek(gem, dac_channel, charge_code):
     return charge_code
 
 
-def _set_scope_time_division(scope, frequency):
-    if frequency > 1200:
-        scope.set_time_division("100us")
-    elif frequency > 700:
-        scope.set_time_division("200us")
-    elif frequency > 180:
-        scope.set_time_division("500us")
-    elif frequency > 90:
-        scope.set_time_division("1ms")
-    elif frequency > 46:
-        scope.set_time_division("2ms")
-    else:
-        scope.set_time_division("5ms")
+def _progress_steps(count):
+    """Returns the progress and bar color for each of count steps, so that the
+    gradient doesn't need to be recalculated on every iteration."""
+    progress_values = [n / (count - 1) for n in range(count)]
+    return [
+        (progress, tui.gradient(start_color, end_color, progress))
+        for progress in progress_values
+    ]
+
+
+def _fit_line(xs, ys):
+    """Least-squares fit of a line through the given points, returns
+    (slope, intercept)."""
+    x_mean = statistics.fmean(xs)
+    y_mean = statistics.fmean(ys)
+    numerator = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    denominator = sum((x - x_mean) ** 2 for x in xs)
+    slope = numerator / denominator
+    return slope, y_mean - (slope * x_mean)
+
 
+def _time_division_for_frequency(frequency):
+    return TIME_DIVISIONS[bisect.bisect_left(TIME_DIVISION_FREQUENCIES, frequency)]
 
-def _calibrate_oscillator(gem, scope, oscillator):
+
+def _calibrate_oscillators(gem, scope):
+    """Calibrates Castor and Pollux together - both oscillators are set to
+    each period and seeked in turn, so the scope only needs to be configured
+    and stepped through the time divisions once."""
     bar = tui.Bar()
 
-    if oscillator == 0:
-        scope_channel = "c1"
-        scope.enable_channel("c1")
-        scope.disable_channel("c2")
-        dac_channel = 0
-    else:
-        scope_channel = "c2"
-        scope.enable_channel("c2")
-        scope.disable_channel("c1")
-        dac_channel = 2
+    # Castor is observed on C1 and charged by DAC channel 0, Pollux is observed
+    # on C2 and charged by DAC channel 2.
+    channels = (("Castor", "c1", 0), ("Pollux", "c2", 2))
 
-    scope.set_trigger_level(scope_channel, "1.65V")
+    scope.enable_channel("c1")
+    scope.enable_channel("c2")
     scope.set_cursor_type("Y")
-    scope.set_vertical_cursor(scope_channel, "-3.3V", "0V")
-    scope.set_vertical_division(scope_channel, "800mV")
-    scope.set_vertical_offset(scope_channel, "-1.65V")
-    scope.show_measurement(scope_channel, "PKPK")
-    scope.show_measurement(scope_channel, "MAX")
+    # Vertical division and offset are already set for both channels in run().
+    for _, scope_channel, _ in channels:
+        scope.set_vertical_cursor(scope_channel, "-3.3V", "0V")
+        scope.show_measurement(scope_channel, "PKPK")
+        scope.show_measurement(scope_channel, "MAX")
 
-    scope.set_time_division("10ms")
+    time_division = "10ms"
+    scope.set_time_division(time_division)
 
     # Wait a moment for the scope to get ready.
     time.sleep(0.2)
 
-    last_dac_code = 0
-
-    for n, (period, dac_code) in enumerate(period_to_dac_code.items()):
-        progress = n / (len(period_to_dac_code) - 1)
-
-        if dac_code < last_dac_code:
-            dac_code = last_dac_code
-
-        # Adjust the oscilloscope's time division as needed.
-        frequency = oscillators.timer_period_to_frequency(period)
-        _set_scope_time_division(scope, frequency)
+    # Each oscillator starts from its own reference calibration. The reference
+    # is never modified, results are collected separately.
+    references = (reference_calibration.castor, reference_calibration.pollux)
+    periods = list(reference_calibration.castor.keys())
+    frequencies = [oscillators.timer_period_to_frequency(period) for period in periods]
+    calibrated = ([0] * len(periods), [0] * len(periods))
+    calibrations = ({}, {})
+    progress_steps = _progress_steps(len(periods))
+
+    for n, period in enumerate(periods):
+        progress, color = progress_steps[n]
+
+        # Adjust the oscilloscope's time division as needed, most points share
+        # the same division so only send it when it changes.
+        frequency = frequencies[n]
+        new_time_division = _time_division_for_frequency(frequency)
+        if new_time_division != time_division:
+            time_division = new_time_division
+            scope.set_time_division(time_division)
 
         bar.draw(
-            tui.Segment(progress, color=tui.gradient(start_color, end_color, progress)),
+            tui.Segment(progress, color=color),
         )
 
-        log.info(f"Calibrating ramp for {frequency=:.2f} Hz {period=}")
+        log.info(f"Calibrating ramps for {frequency=:.2f} Hz {period=}")
 
-        # If we've measured more than twice, we have enough info to determine
-        # the slope of the charge voltage - it should be pretty much linear, so
-        # we can guess a code very close to the right one.
-        if n > 2:
-            x_1, y_1 = list(period_to_dac_code.items())[n - 1]
-            x_2, y_2 = list(period_to_dac_code.items())[0]
-            x_1 = oscillators.timer_period_to_frequency(x_1)
-            x_2 = oscillators.timer_period_to_frequency(x_2)
-            slope = (y_2 - y_1) / (x_2 - x_1)
-            y_intercept = y_2 - (slope * x_2)
-            dac_code = min(4095, round(y_intercept + (slope * frequency)))
-            log.info(f"Guessed DAC code as {dac_code} from slope {slope:02f}")
+        for oscillator, (name, scope_channel, dac_channel) in enumerate(channels):
+            last_dac_code = calibrated[oscillator][n - 1] if n else 0
+            dac_code = max(references[oscillator][period], last_dac_code)
 
-        gem.set_period(oscillator, period)
+            # If we've measured more than twice, we have enough info to determine
+            # the slope of the charge voltage - it should be pretty much linear, so
+            # fitting a line through all of the previous measurements lets us guess
+            # a code very close to the right one.
+            if n > 2:
+                slope, y_intercept = _fit_line(
+                    frequencies[:n], calibrated[oscillator][:n]
+                )
+                dac_code = min(4095, round(y_intercept + (slope * frequency)))
+                log.info(
+                    f"Guessed {name} DAC code as {dac_code} from slope {slope:02f}"
+                )
 
-        calibrated_code = _manual_seek(gem, dac_channel, dac_code)
+            # Trigger on the channel being adjusted, the other oscillator may
+            # be at a different period or code.
+            scope.set_trigger_level(scope_channel, "1.65V")
+            log.info(f"Adjusting {name}, watch {scope_channel.upper()}")
+            calibrated_code = _manual_seek(
+                gem, oscillator, period, dac_channel, dac_code
+            )
 
-        period_to_dac_code[period] = calibrated_code
+            calibrated[oscillator][n] = calibrated_code
+            calibrations[oscillator][period] = calibrated_code
 
-        magnitude = _measure_max(scope, scope_channel)
+        for oscillator, (name, scope_channel, _) in enumerate(channels):
+            calibrated_code = calibrated[oscillator][n]
+            magnitude = _measure_max(scope, scope_channel)
 
-        log.success(
-            f"Calibrated to {calibrated_code} ({oscillators.charge_code_to_volts(calibrated_code):.03f} volts), magnitude: {magnitude:.2f} volts"
-        )
-
-        last_dac_code = calibrated_code
+            log.success(
+                f"Calibrated {name} to {calibrated_code} ({oscillators.charge_code_to_volts(calibrated_code):.03f} volts), magnitude: {magnitude:.2f} volts"
+            )
 
-    return period_to_dac_code.copy()
+    return calibrations
 
 
 def run(save):
@@ -142,13 +173,14 @@ def run(save):
     gem = gemini.Gemini()
     gem.enter_calibration_mode()
 
-    initial_period, initial_dac_code = next(iter(period_to_dac_code.items()))
-    time.sleep(0.1)
-    gem.set_period(0, initial_period)
-    gem.set_dac(0, initial_dac_code, 0)
-    time.sleep(0.1)
-    gem.set_period(1, initial_period)
-    gem.set_dac(2, initial_dac_code, 0)
+    initial_period = next(iter(reference_calibration.castor))
+    gem.wait_until_ready()
+    gem.set_period_and_dac(
+        0, initial_period, 0, reference_calibration.castor[initial_period], 0
+    )
+    gem.set_period_and_dac(
+        1, initial_period, 2, reference_calibration.pollux[initial_period], 0
+    )
 
     # Oscilloscope setup.
     log.info("Configuring oscilloscope...")
@@ -175,23 +207,18 @@ def run(save):
     interactive.continue_when_ready()
 
     # Calibrate both oscillators
-    log.section("Calibrating Castor...", depth=2)
-    castor_calibration = _calibrate_oscillator(gem, scope, 0)
-
-    lowest_voltage = oscillators.charge_code_to_volts(min(castor_calibration.values()))
-    highest_voltage = oscillators.charge_code_to_volts(max(castor_calibration.values()))
-    log.success(
-        f"\nCalibrated:\n- Lowest: {lowest_voltage:.2f}v\n- Highest: {highest_voltage:.2f}v\n"
-    )
-
-    log.section("Calibrating Pollux...", depth=2)
-    pollux_calibration = _calibrate_oscillator(gem, scope, 1)
-
-    lowest_voltage = oscillators.charge_code_to_volts(min(pollux_calibration.values()))
-    highest_voltage = oscillators.charge_code_to_volts(max(pollux_calibration.values()))
-    log.success(
-        f"\nCalibrated:\n- Lowest: {lowest_voltage:.2f}v\n- Highest: {highest_voltage:.2f}v\n"
-    )
+    log.section("Calibrating Castor & Pollux...", depth=2)
+    castor_calibration, pollux_calibration = _calibrate_oscillators(gem, scope)
+
+    for name, calibration in (
+        ("Castor", castor_calibration),
+        ("Pollux", pollux_calibration),
+    ):
+        lowest_voltage = oscillators.charge_code_to_volts(min(calibration.values()))
+        highest_voltage = oscillators.charge_code_to_volts(max(calibration.values()))
+        log.success(
+            f"\n{name} calibrated:\n- Lowest: {lowest_voltage:.2f}v\n- Highest: {highest_voltage:.2f}v\n"
+        )
 
     log.section("Saving calibration table...", depth=2)
 
@@ -213,32 +240,33 @@ def run(save):
 
         log.info("Sending LUT values to device...")
 
+        progress_steps = _progress_steps(len(castor_calibration))
+
         with output:
             for n, timer_period in enumerate(castor_calibration.keys()):
-                progress = n / (len(castor_calibration.values()) - 1)
-                bar.draw(
-                    tui.Segment(
-                        progress,
-                        color=tui.gradient(start_color, end_color, progress),
-                    ),
-                )
+                progress, color = progress_steps[n]
+                bar.draw(tui.Segment(progress, color=color))
                 output.update()
 
                 castor_code = castor_calibration[timer_period]
                 pollux_code = pollux_calibration[timer_period]
 
-                gem.write_lut_entry(n, timer_period, castor_code, pollux_code)
+                gem.write_lut_entry(
+                    n, timer_period, castor_code, pollux_code, wait_for_ack=False
+                )
 
                 log.debug(
-                    f"Set LUT entry {n} to {timer_period=}, {castor_code=}, {pollux_code=}."
+                    f"Sent LUT entry {n} with {timer_period=}, {castor_code=}, {pollux_code=}."
                 )
 
+        # Entries are sent without waiting on each one, so make sure the device
+        # has received all of them before committing.
+        gem.wait_for_lut_entry_acks(len(castor_calibration))
+
         log.info("Committing LUT to NVM...")
         gem.write_lut()
 
-        checksum = 0
-        for dac_code in castor_calibration.values():
-            checksum ^= dac_code
+        checksum = functools.reduce(operator.xor, castor_calibration.values(), 0)
 
         log.success(f"Calibration table written, checksum: {checksum:04x}")
 
@@ -83,6 +83,7 @@ static void cmd_0x10_monitor_(const uint8_t* data, size_t len);
 static void cmd_0x11_soft_reset_(const uint8_t* data, size_t len);
 static void cmd_0x12_enter_calibration_mode_(const uint8_t* data, size_t len);
 static void cmd_0x13_reset_into_bootloader_(const uint8_t* data, size_t len);
+static void cmd_0x14_set_period_and_dac_(const uint8_t* data, size_t len);
 
 /* Public functions. */
 
@@ -106,6 +107,7 @@ void gem_register_sysex_commands() {
     wntr_midi_register_sysex_command(0x11, cmd_0x11_soft_reset_);
     wntr_midi_register_sysex_command(0x12, cmd_0x12_enter_calibration_mode_);
     wntr_midi_register_sysex_command(0x13, cmd_0x13_reset_into_bootloader_);
+    wntr_midi_register_sysex_command(0x14, cmd_0x14_set_period_and_dac_);
 };
 
 void gem_sysex_send_monitor_update(struct GemMonitorUpdate* update) {
@@ -381,3 +383,19 @@ static void cmd_0x13_reset_into_bootloader_(const uint8_t* data, size_t len) {
 
     wntr_reset_into_bootloader();
 }
+
+static void cmd_0x14_set_period_and_dac_(const uint8_t* data, size_t len) {
+    /*
+        Combines SET_PERIOD and SET_DAC so that calibration can change both in
+        a single message.
+        Request (teeth): CHANNEL(1) PERIOD(4) DAC_CHANNEL(1) VALUE(2) VREF(1)
+    */
+    DECODE_TEETH_REQUEST(9);
+
+    gem_pulseout_set_period(request[0], WNTR_UNPACK_32(request, 1));
+
+    struct GemMCP4278Channel dac_settings = {};
+    dac_settings.vref = request[8];
+    dac_settings.value = WNTR_UNPACK_16(request, 6);
+    gem_mcp_4728_write_channel(request[5], dac_settings);
+}